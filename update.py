@@ -4,26 +4,53 @@
 update.py
 - 自动识别 Base64 / Clash YAML / 纯文本 URI
 - 新增：订阅分组（有效/失效）
-- 节点去重后写入 config.txt
+- 节点去重后写入 all.txt 及各协议文件
 - 所有文件自动创建并写入
 """
 import base64
+import binascii
+import codecs
+import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
 import re
 import sys
-import time
 import urllib.parse
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from typing import Dict, List, Tuple
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:                            # 优先使用 libyaml 的 C 加载器
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:                            # 有 pybase64 时走 SIMD 解码，否则回退 binascii
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from binascii import a2b_base64 as _b64decode
+
+try:                            # 有 orjson 时走 C 实现，否则回退标准库
+    import orjson
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
 
 # ---------- 路径 ----------
 REPO_ROOT    = os.path.dirname(os.path.abspath(__file__))
 SUB_FILE     = os.path.join(REPO_ROOT, 'sub.txt')
 VALID_FILE   = os.path.join(REPO_ROOT, 'sub_valid.txt')
 INVALID_FILE = os.path.join(REPO_ROOT, 'sub_invalid.txt')
-OUT_FILE     = os.path.join(REPO_ROOT, 'config.txt')
 
 PROTO_FILES = {                 # 协议 → 文件名
     'ss': 'ss.txt',
@@ -39,198 +66,265 @@ PROTO_FILES = {                 # 协议 → 文件名
     'clash': 'clash.yaml'       # 完整 Clash YAML 单独保存
 }
 ALL_FILE = 'all.txt'           # 总节点文件
+URI_SCHEMES = frozenset(PROTO_FILES) - {'clash'}   # 可按 URI 协议头分桶的协议
 
 TIMEOUT = 10
-MAX_RETRIES = 3
+MAX_RETRIES = 3          # 连接错误及 429/5xx 的重试次数，带指数退避
+MAX_BYTES = 64 << 20     # 单条订阅体积上限，防止异常大响应撑爆内存
+CHUNK_SIZE = 64 << 10    # 流式读取块大小
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 10))   # 并发下载线程数，可用环境变量调整
 MIN_NODES_PER_SUB = 20   # 每条订阅最少节点数，低于此数视为低质量
+LOG_BUFFER = 1024        # 日志缓冲条数
+WRITE_BUFFER = 1 << 20   # 输出文件写缓冲 1 MiB
+
+log = logging.getLogger('update')
+
+_B64_RE = re.compile(rb'[A-Za-z0-9+/=_\-\s]+')  # Base64（含 urlsafe）字符集
+_B64_SAMPLE = 4096                               # 只抽查开头，完整校验交给解码
+_URLSAFE_TO_STD = bytes.maketrans(b'-_', b'+/')  # urlsafe → 标准字母表
+_URI_HEAD_RE = re.compile(r'\s*[A-Za-z][A-Za-z0-9+.-]*://')   # 正文以 URI 开头
+_YAML_KEY_RE = re.compile(                       # Clash YAML 顶层键，一次扫描
+    r'^(proxies|Proxy|proxy-providers)\s*:', re.MULTILINE | re.IGNORECASE)
+_YAML_KEY_ORDER = ('proxies', 'proxy', 'proxy-providers')   # 多个键并存时的取用优先级
 
 # ---------- 工具 ----------
-def _ensure_files(*paths):
-    for p in paths:
-        os.makedirs(os.path.dirname(p), exist_ok=True)
-
-def 下载(url: str) -> bytes:
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    for i in range(MAX_RETRIES):
-        try:
-            resp = requests.get(url, headers=headers, timeout=TIMEOUT)
+def _write_lines(path: str, lines: List[str], header: str = ''):
+    """经 1 MiB 缓冲逐行写出，不拼整块大字符串；header 非空时作为首行"""
+    with open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as f:
+        f.write(header)
+        f.writelines(f'{ln}\n' for ln in lines)
+
+def 下载(url: str, session: requests.Session) -> bytes:
+    """重试与退避由 session 上挂载的 urllib3 Retry 负责"""
+    try:
+        with session.get(url, timeout=TIMEOUT, stream=True) as resp:
             resp.raise_for_status()
-            return resp.content
-        except Exception as e:
-            print(f'[警告] 下载失败：{url}  {e}')
-            time.sleep(2)
-    return b''
-
-def _try_base64(data: str) -> str:
-    data += '=' * (-len(data) % 4)
+            buf = bytearray()
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                buf += chunk
+                if len(buf) > MAX_BYTES:
+                    log.warning('[警告] 订阅超过 %d MiB，已跳过：%s', MAX_BYTES >> 20, url)
+                    return b''
+            return bytes(buf)
+    except (requests.RequestException, ValueError) as e:   # 畸形 URL 会抛 urllib3 的 ValueError
+        log.warning('[警告] 下载失败：%s  %s', url, e)
+        return b''
+
+def _try_base64(data: bytes) -> str:
+    data = data.removeprefix(codecs.BOM_UTF8)   # 带 BOM 的 Base64 也能通过字符集检查
+    if not _B64_RE.fullmatch(data[:_B64_SAMPLE]):
+        return ''
+    data = b''.join(data.split())         # 去掉换行等空白后再按实际长度补齐
+    data += b'=' * (-len(data) & 3)
     try:
-        return base64.urlsafe_b64decode(data.encode()).decode('utf-8')
-    except Exception:
+        return _b64decode(data.translate(_URLSAFE_TO_STD)).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        return ''
+
+# ---------- Clash proxy → URI，按 type 查表分派 ----------
+def _ss_uri(proxy: dict, name: str, server: str, port) -> str:
+    cipher, pwd = proxy.get('cipher', ''), proxy.get('password', '')
+    if not cipher or not pwd:
+        return ''
+    auth = base64.urlsafe_b64encode(f'{cipher}:{pwd}'.encode()).decode()
+    return f'ss://{auth}@{server}:{port}#{name}'
+
+def _vmess_uri(proxy: dict, _name: str, server: str, port) -> str:
+    # ps 放在 JSON 里，要原始名称而非 URL 编码后的；_name 仅为与其他处理函数签名一致
+    g = proxy.get
+    uuid = g('uuid', '')
+    if not uuid:
+        return ''
+    ws_opts = g('ws-opts') or {}
+    host = (g('ws-headers') or {}).get('Host') or (ws_opts.get('headers') or {}).get('Host', '')
+    vm = {
+        "v": "2", "ps": g('name', ''), "add": server, "port": str(port),
+        "id": uuid, "aid": str(g('alterId', 0)),
+        "net": g('network', 'tcp'), "type": 'none',        # 伪装类型，不是 Clash 的代理类型
+        "host": host,
+        "path": g('ws-path') or ws_opts.get('path', ''),
+        "tls": 'tls' if g('tls', False) else ''
+    }
+    b64 = base64.urlsafe_b64encode(_json_dumps(vm).encode()).decode()
+    return f'vmess://{b64}'
+
+def _trojan_uri(proxy: dict, name: str, server: str, port) -> str:
+    pwd = proxy.get('password', '')
+    if not pwd:
+        return ''
+    sni = proxy.get('sni', '')
+    return f'trojan://{pwd}@{server}:{port}?sni={sni}#{name}'
+
+def _vless_uri(proxy: dict, name: str, server: str, port) -> str:
+    g = proxy.get
+    uuid = g('uuid', '')
+    if not uuid:
+        return ''
+    net = g('network', 'tcp')
+    tls = 'tls' if g('tls', False) else ''
+    ws_opts = g('ws-opts') or {}
+    host = (ws_opts.get('headers') or {}).get('Host', '')
+    path = ws_opts.get('path', '')
+    return f'vless://{uuid}@{server}:{port}?type={net}&security={tls}&host={host}&path={path}#{name}'
+
+def _hysteria_uri(proxy: dict, name: str, server: str, port) -> str:
+    auth = proxy.get('auth', proxy.get('password', ''))
+    if not auth:
+        return ''
+    t = proxy['type'].lower()             # hysteria / hysteria2
+    alpn = ','.join(proxy.get('alpn', []))
+    return f'{t}://{auth}@{server}:{port}?alpn={alpn}#{name}'
+
+def _tuic_uri(proxy: dict, name: str, server: str, port) -> str:
+    uuid = proxy.get('uuid', '')
+    pwd = proxy.get('password', '')
+    if not uuid or not pwd:
         return ''
+    return f'tuic://{uuid}:{pwd}@{server}:{port}#{name}'
+
+_CLASH_HANDLERS = {
+    'ss': _ss_uri,
+    'vmess': _vmess_uri,
+    'trojan': _trojan_uri,
+    'vless': _vless_uri,
+    'hysteria': _hysteria_uri,
+    'hysteria2': _hysteria_uri,
+    'tuic': _tuic_uri,
+}
 
 def _clash_to_uri(proxy: dict) -> str:
-    t = proxy.get('type', '').lower()
-    name = urllib.parse.quote(proxy.get('name', ''))
+    handler = _CLASH_HANDLERS.get(proxy.get('type', '').lower())
     server = proxy.get('server', '')
     port = proxy.get('port', 0)
-    if not server or not port:
+    if handler is None or not server or not port:
         return ''
-    if t == 'ss':
-        cipher, pwd = proxy.get('cipher', ''), proxy.get('password', '')
-        if not cipher or not pwd:
-            return ''
-        auth = base64.urlsafe_b64encode(f'{cipher}:{pwd}'.encode()).decode()
-        return f'ss://{auth}@{server}:{port}#{name}'
-    if t == 'vmess':
-        vm = {
-            "v": "2", "ps": name, "add": server, "port": str(port),
-            "id": proxy.get('uuid', ''), "aid": str(proxy.get('alterId', 0)),
-            "net": proxy.get('network', 'tcp'), "type": proxy.get('type', 'none'),
-            "host": proxy.get('ws-headers', {}).get('Host', '') or proxy.get('ws-opts', {}).get('headers', {}).get('Host', ''),
-            "path": proxy.get('ws-path', '') or proxy.get('ws-opts', {}).get('path', ''),
-            "tls": 'tls' if proxy.get('tls', False) else ''
-        }
-        if not vm['id']:
-            return ''
-        b64 = base64.urlsafe_b64encode(str(vm).encode()).decode()
-        return f'vmess://{b64}'
-    if t == 'trojan':
-        pwd = proxy.get('password', '')
-        if not pwd:
-            return ''
-        sni = proxy.get('sni', '')
-        return f'trojan://{pwd}@{server}:{port}?sni={sni}#{name}'
-    if t == 'vless':
-        uuid = proxy.get('uuid', '')
-        if not uuid:
-            return ''
-        net = proxy.get('network', 'tcp')
-        tls = 'tls' if proxy.get('tls', False) else ''
-        host = proxy.get('ws-opts', {}).get('headers', {}).get('Host', '')
-        path = proxy.get('ws-opts', {}).get('path', '')
-        return f'vless://{uuid}@{server}:{port}?type={net}&security={tls}&host={host}&path={path}#{name}'
-    if t in ('hysteria', 'hysteria2'):
-        auth = proxy.get('auth', proxy.get('password', ''))
-        if not auth:
-            return ''
-        alpn = ','.join(proxy.get('alpn', []))
-        return f'{t}://{auth}@{server}:{port}?alpn={alpn}#{name}'
-    if t == 'tuic':
-        uuid = proxy.get('uuid', '')
-        pwd = proxy.get('password', '')
-        if not uuid or not pwd:
-            return ''
-        return f'tuic://{uuid}:{pwd}@{server}:{port}#{name}'
-    return ''
-
-def 提取节点(raw: bytes) -> List[str]:
-    if not raw:
-        return []
+    return handler(proxy, urllib.parse.quote(proxy.get('name', '')), server, port)
+
+def _classify(raw: bytes) -> Tuple[str, str]:
+    """解码正文；像 Clash YAML 时一并返回正文里的顶层键（原样写法），否则键为空串"""
+    text = raw.decode('utf-8-sig', errors='replace')   # 顺带去掉开头的 BOM
+    # 没有冒号，或开头就是 URI 的节点列表，都不可能是，免去整段正则扫描
+    if b':' not in raw or _URI_HEAD_RE.match(text):
+        return text, ''
+    # 按优先级选键，而不是按出现先后：proxy-providers 写在 proxies 前面时仍取内联节点
+    found: Dict[str, str] = {}
+    for m in _YAML_KEY_RE.finditer(text):
+        found.setdefault(m.group(1).lower(), m.group(1))
+    return text, next((found[k] for k in _YAML_KEY_ORDER if k in found), '')
+
+def _parse_clash(text: str, key: str) -> List[str]:
+    """解析 Clash YAML 并转成 URI；在子进程里运行"""
     try:
-        text = raw.decode('utf-8')
-    except UnicodeDecodeError:
-        text = raw.decode('latin-1')
-
-    # 1. Clash YAML
-    for key in ('proxies', 'Proxy', 'proxy-providers'):
-        if re.search(rf'^{key}\s*:', text, flags=re.MULTILINE | re.IGNORECASE):
-            try:
-                data = yaml.safe_load(text)
-                proxies = data.get(key, []) if key != 'proxy-providers' else \
-                          [p for v in data.get(key, {}).values() for p in v.get('proxies', [])]
-                return [_clash_to_uri(p) for p in proxies if _clash_to_uri(p)]
-            except Exception:
-                return []
-
-    # 2. Base64
-    decoded = _try_base64(text)
+        data = yaml.load(text, Loader=_YamlLoader)
+        proxies = data.get(key, []) if key.lower() != 'proxy-providers' else \
+                  [p for v in data.get(key, {}).values() for p in v.get('proxies', [])]
+        uris = [_clash_to_uri(p) for p in proxies if type(p) is dict]
+        return [u for u in uris if u]
+    except Exception:
+        return []
+
+def _split_nodes(raw: bytes, text: str) -> List[str]:
+    """Base64 或纯文本节点列表，按行切分"""
+    decoded = _try_base64(raw)
     if decoded:
-        return [ln.strip() for ln in decoded.splitlines() if ln.strip()]
+        return [ln for ln in map(str.strip, decoded.splitlines()) if ln]
+    return [ln for ln in map(str.strip, text.splitlines()) if ln]
 
-    # 3. 纯文本行
-    return [ln.strip() for ln in text.splitlines() if ln.strip()]
+def 拉取节点(urls: List[str], session: requests.Session) -> List[List[str]]:
+    """
+    线程池并发下载；只有 Clash YAML 送进程池并行解析（受 GIL 限制），
+    Base64/纯文本切行很快，直接在下载线程里完成。结果顺序与 urls 一致；
+    内容相同的订阅（镜像、转载）只解析一次
+    """
+    parsed: Dict[bytes, List[str]] = {}
+
+    # 主进程已有下载线程，子进程用 spawn 启动，避免 fork 带走线程持有的锁；
+    # 进程在首次提交时才启动，没有 YAML 订阅就不会启动
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as procs, \
+         ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+
+        def 抓取(url: str) -> List[str]:
+            raw = 下载(url, session)
+            digest = hashlib.blake2b(raw, digest_size=16).digest()
+            nodes = parsed.get(digest)
+            if nodes is None:
+                text, key = _classify(raw)
+                if not key:
+                    nodes = _split_nodes(raw, text)
+                else:
+                    # 子进程异常退出（如 OOM）时进程池整体失效，按无节点处理，不中断整次运行
+                    try:
+                        nodes = procs.submit(_parse_clash, text, key).result()
+                    except Exception as e:
+                        log.warning('[警告] 解析失败：%s  %r', url, e)
+                        nodes = []
+                parsed[digest] = nodes
+            return nodes
+
+        return list(pool.map(抓取, urls))
 
 def main():
-    # 确保目录存在
-    for p in (SUB_FILE, VALID_FILE, INVALID_FILE, OUT_FILE, *PROTO_FILES.values()):
-        os.makedirs(os.path.dirname(os.path.join(REPO_ROOT, p)), exist_ok=True)
+    # 日志先攒在内存里，满 LOG_BUFFER 条或退出时一次性写出；
+    # 只挂在本模块 logger 上，urllib3 的重试告警不混进 log.txt / README
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(logging.handlers.MemoryHandler(LOG_BUFFER, target=out))
+    log.setLevel(logging.INFO)
+    log.propagate = False
 
     # 读取订阅
     try:
-        links = [ln.strip() for ln in open(SUB_FILE, encoding='utf-8') if ln.strip()]
+        with open(SUB_FILE, encoding='utf-8') as f:
+            links = list(dict.fromkeys(filter(None, map(str.strip, f))))
     except FileNotFoundError:
         links = []
 
     if not links:
-        print('[提示] sub.txt 为空，请添加订阅后重试')
+        log.info('[提示] sub.txt 为空，请添加订阅后重试')
         sys.exit(0)
 
-    # 检测有效性
-    valid, invalid = [], []
-    for url in links:
-        (valid if len(提取节点(下载(url))) > 0 else invalid).append(url)
+    # 共享会话：复用 TCP/TLS 连接
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    # 不理会 Retry-After：它的等待不受 TIMEOUT 约束，个别站点给个大值就能拖住整次运行
+    retry = Retry(total=MAX_RETRIES, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # 拉取并检测有效性：每条订阅只下载一次，有节点即有效
+    results = list(zip(links, 拉取节点(links, session)))
+    session.close()
+    valid = [url for url, nodes in results if nodes]
+    invalid = [url for url, nodes in results if not nodes]
+    # 边合并边去重（保序），不再先拼出含重复的大列表
+    all_nodes = list(dict.fromkeys(chain.from_iterable(nodes for _, nodes in results)))
 
     # 写分组文件
-    with open(VALID_FILE, 'w', encoding='utf-8') as f:
-        f.write(f'# 有效订阅（共 {len(valid)} 条）\n' + '\n'.join(valid) + '\n')
-    with open(INVALID_FILE, 'w', encoding='utf-8') as f:
-        f.write(f'# 失效订阅（共 {len(invalid)} 条）\n' + '\n'.join(invalid) + '\n')
+    _write_lines(VALID_FILE, valid, f'# 有效订阅（共 {len(valid)} 条）\n')
+    _write_lines(INVALID_FILE, invalid, f'# 失效订阅（共 {len(invalid)} 条）\n')
 
-    print(f'[分组] 有效 {len(valid)} 条')
-    print(f'[分组] 失效 {len(invalid)} 条')
+    log.info('[分组] 有效 %d 条', len(valid))
+    log.info('[分组] 失效 %d 条', len(invalid))
 
-    # 协议桶
+    # 按协议分类：一次 partition 取协议头，查表入桶，未识别协议只进 all
     protocol_nodes = {proto: [] for proto in PROTO_FILES}
-    all_nodes = []
-
-    # 拉取并分类
-    for url in valid:
-        raw = 下载(url)
-        tmp_nodes = 提取节点(raw)
-        all_nodes.extend(tmp_nodes)
-
-        # 按协议分类
-        for node in tmp_nodes:
-            if node.startswith('ss://'):
-                protocol_nodes['ss'].append(node)
-            elif node.startswith('ssr://'):
-                protocol_nodes['ssr'].append(node)
-            elif node.startswith('vmess://'):
-                protocol_nodes['vmess'].append(node)
-            elif node.startswith('vless://'):
-                protocol_nodes['vless'].append(node)
-            elif node.startswith('trojan://'):
-                protocol_nodes['trojan'].append(node)
-            elif node.startswith('hysteria://'):
-                protocol_nodes['hysteria'].append(node)
-            elif node.startswith('hysteria2://'):
-                protocol_nodes['hysteria2'].append(node)
-            elif node.startswith('tuic://'):
-                protocol_nodes['tuic'].append(node)
-            elif node.startswith('naive+https://'):
-                protocol_nodes['naive+https'].append(node)
-            elif node.startswith('wireguard://'):
-                protocol_nodes['wireguard'].append(node)
-            else:
-                # 未识别协议也进 all
-                pass
-
-    # 去重（保序）
-    for proto in protocol_nodes:
-        protocol_nodes[proto] = list(dict.fromkeys(protocol_nodes[proto]))
-
-    all_nodes = list(dict.fromkeys(all_nodes))
+    for node in all_nodes:
+        scheme, sep, _ = node.partition('://')
+        if sep and scheme in URI_SCHEMES:
+            protocol_nodes[scheme].append(node)
 
     # 写入各协议文件
     for proto, filename in PROTO_FILES.items():
-        with open(os.path.join(REPO_ROOT, filename), 'w', encoding='utf-8') as f:
-            f.write('\n'.join(protocol_nodes[proto]) + '\n')
-        print(f'[写入] {filename} : {len(protocol_nodes[proto])} 条')
+        _write_lines(os.path.join(REPO_ROOT, filename), protocol_nodes[proto])
+        log.info('[写入] %s : %d 条', filename, len(protocol_nodes[proto]))
 
     # 总节点
-    with open(os.path.join(REPO_ROOT, ALL_FILE), 'w', encoding='utf-8') as f:
-        f.write('\n'.join(all_nodes) + '\n')
-    print(f'[完成] {ALL_FILE} : {len(all_nodes)} 条')
+    _write_lines(os.path.join(REPO_ROOT, ALL_FILE), all_nodes)
+    log.info('[完成] %s : %d 条', ALL_FILE, len(all_nodes))
 
 
 if __name__ == '__main__':